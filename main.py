@@ -3,13 +3,23 @@ import os
 import re
 import io
 import json
+import time
+import random
 import base64
 import asyncio
 import logging
-from typing import List, Optional, Tuple
-
+import concurrent.futures
+import threading
+import email.utils
+from collections import OrderedDict
+from email.message import Message
+from typing import List, NamedTuple, Optional, Tuple
+
+import httplib2
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
 from telegram import Update
@@ -25,8 +35,62 @@ XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 GOOGLE_DOC_MIME = "application/vnd.google-apps.document"
 GOOGLE_SHEET_MIME = "application/vnd.google-apps.spreadsheet"
 
+def _env_user_ids(name: str) -> frozenset:
+    raw = os.environ.get(name, "")
+    try:
+        return frozenset(int(x) for x in raw.split(",") if x.strip())
+    except ValueError:
+        raise RuntimeError(f"Invalid env var {name}: expected comma-separated numeric user ids, got {raw!r}") from None
+
+# Telegram user ids allowed to use the bot (comma-separated); empty means everyone
+_ALLOWED_IDS = _env_user_ids("ALLOWED_USER_ID")
+
+# Bytes per ranged request when downloading an export
+CHUNK_SIZE = int(os.environ.get("GDRIVE_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+# Drive statuses worth retrying a download chunk on
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CHUNK_ATTEMPTS = 5
+
+# Link kind -> (export mimeType, extension) for links whose type is known from the URL
+KIND_EXPORTS = {
+    "doc": (DOCX_MIME, ".docx"),
+    "sheet": (XLSX_MIME, ".xlsx"),
+}
+
+_LINK_RE = re.compile(
+    r"(?:/document/d/(?P<doc>[a-zA-Z0-9_-]+))"
+    r"|(?:/spreadsheets/d/(?P<sheet>[a-zA-Z0-9_-]+))"
+    r"|(?:/file/d/(?P<file>[a-zA-Z0-9_-]+))"
+    r"|(?:[?&]id=(?P<id>[a-zA-Z0-9_-]+))"
+)
+_RK_RE = re.compile(r"[?&]resourcekey=([a-zA-Z0-9_-]+)")
+# Regex group name -> link kind
+_LINK_KINDS = {"doc": "doc", "sheet": "sheet", "file": "file", "id": "unknown"}
+_SINGLE_URL_RE = re.compile(
+    r"https?://(?:docs|drive)\.google\.com/(document|spreadsheets|file)/d/([a-zA-Z0-9_-]+)\S*"
+)
+# URL path segment -> link kind
+_URL_KINDS = {"document": "doc", "spreadsheets": "sheet", "file": "file"}
+
+# Threads doing blocking Drive I/O; each keeps its own connection (see get_drive_http)
+_DRIVE_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DRIVE_WORKERS", "4")), thread_name_prefix="drive"
+)
+
+# Exports running at once, across all chats
+_export_semaphore = asyncio.Semaphore(int(os.environ.get("MAX_CONCURRENT_EXPORTS", "4")))
+
+# Finished exports by (file_id, export mimeType), least recently used first
+EXPORT_CACHE_BYTES = int(os.environ.get("EXPORT_CACHE_BYTES", str(50 * 1024 * 1024)))
+_export_cache = OrderedDict()
+_export_cache_size = 0
+_export_cache_lock = threading.Lock()
+
 _drive_service = None
-_sa_json_path = None
+_drive_creds = None
+_drive_lock = threading.Lock()
+_drive_http = threading.local()
 
 def _env(name: str, default: Optional[str] = None) -> str:
     v = os.environ.get(name, default)
@@ -34,98 +98,199 @@ def _env(name: str, default: Optional[str] = None) -> str:
         raise RuntimeError(f"Missing env var: {name}")
     return v
 
-def extract_file_refs(text: str) -> List[Tuple[str, Optional[str]]]:
-    patterns = [
-        r"/document/d/([a-zA-Z0-9_-]+)",
-        r"/spreadsheets/d/([a-zA-Z0-9_-]+)",
-        r"/file/d/([a-zA-Z0-9_-]+)",
-        r"[?&]id=([a-zA-Z0-9_-]+)",
-    ]
-    resource_key_match = re.search(r"[?&]resourcekey=([a-zA-Z0-9_-]+)", text)
+def extract_file_refs(text: str) -> List[Tuple[str, Optional[str], str]]:
+    # Cheap substring check first: most messages contain no Drive link at all
+    if "docs.google.com" not in text and "drive.google.com" not in text and "/d/" not in text:
+        return []
+    # Fast path for the usual message: one bare link. Any second link (another /d/ path
+    # or an id= parameter) goes to the general scanner; the pattern itself rejects whitespace.
+    if text.startswith("http") and text.count("/d/") == 1 and "?id=" not in text and "&id=" not in text:
+        m = _SINGLE_URL_RE.fullmatch(text)
+        if m:
+            # Same resource key lookup as the general scanner, so both paths agree
+            resource_key_match = _RK_RE.search(text)
+            resource_key = resource_key_match.group(1) if resource_key_match else None
+            return [(m.group(2), resource_key, _URL_KINDS[m.group(1)])]
+    resource_key_match = _RK_RE.search(text)
     resource_key = resource_key_match.group(1) if resource_key_match else None
-    ids = []
-    for p in patterns:
-        ids += re.findall(p, text)
-
-    seen = set()
-    out = []
-    for x in ids:
-        if x not in seen:
-            out.append((x, resource_key))
-            seen.add(x)
-    return out
-
-def prepare_service_account_file() -> str:
-    global _sa_json_path
-    if _sa_json_path:
-        return _sa_json_path
-
+    refs = {}
+    for m in _LINK_RE.finditer(text):
+        kind = m.lastgroup
+        refs.setdefault(m.group(kind), _LINK_KINDS[kind])
+    return [(file_id, resource_key, kind) for file_id, kind in refs.items()]
+
+def message_link_text(message) -> str:
+    # Hyperlinked text keeps its URL in an entity; join those with the text so one scan sees all.
+    # A newline can't occur inside a file id, so matches never span two sources.
+    return "\n".join([message.text or ""] + [e.url for e in message.entities if e.url])
+
+class CachedExport(NamedTuple):
+    modified_time: Optional[str]
+    etag: Optional[str]
+    filename: str
+    data: bytes
+
+def cache_get(file_id: str, export_mime: str) -> Optional[CachedExport]:
+    with _export_cache_lock:
+        entry = _export_cache.get((file_id, export_mime))
+        if entry is not None:
+            _export_cache.move_to_end((file_id, export_mime))
+        return entry
+
+def cache_put(file_id: str, export_mime: str, entry: CachedExport) -> None:
+    global _export_cache_size
+    if len(entry.data) > EXPORT_CACHE_BYTES:
+        return
+    with _export_cache_lock:
+        old = _export_cache.pop((file_id, export_mime), None)
+        if old is not None:
+            _export_cache_size -= len(old.data)
+        _export_cache[(file_id, export_mime)] = entry
+        _export_cache_size += len(entry.data)
+        while _export_cache_size > EXPORT_CACHE_BYTES:
+            _, evicted = _export_cache.popitem(last=False)
+            _export_cache_size -= len(evicted.data)
+
+def load_service_account_info() -> dict:
     b64 = _env("GOOGLE_SA_JSON_B64")
-    raw = base64.b64decode(b64.encode("utf-8"))
-    json.loads(raw.decode("utf-8"))  # sanity check
-
-    path = "/tmp/service_account.json"
-    with open(path, "wb") as f:
-        f.write(raw)
-
-    _sa_json_path = path
-    return path
+    return json.loads(base64.b64decode(b64))
 
 def get_drive_service():
-    global _drive_service
-    if _drive_service is not None:
+    global _drive_service, _drive_creds
+    with _drive_lock:
+        if _drive_service is not None:
+            return _drive_service
+
+        _drive_creds = Credentials.from_service_account_info(load_service_account_info(), scopes=SCOPES)
+        _drive_service = build("drive", "v3", credentials=_drive_creds, cache_discovery=False)
         return _drive_service
 
-    sa_path = prepare_service_account_file()
-    creds = Credentials.from_service_account_file(sa_path, scopes=SCOPES)
-    _drive_service = build("drive", "v3", credentials=creds, cache_discovery=False)
-    return _drive_service
+def get_drive_http() -> AuthorizedHttp:
+    # httplib2.Http is not thread-safe, so each worker thread keeps its own
+    # and reuses the kept-alive TCP/TLS connection across exports
+    http = getattr(_drive_http, "http", None)
+    if http is None:
+        get_drive_service()
+        http = AuthorizedHttp(_drive_creds, http=httplib2.Http(cache=None, timeout=30))
+        _drive_http.http = http
+    return http
+
+def _set_headers(req, headers: dict):
+    if not headers:
+        return
+    # req.headers can be None in some googleapiclient versions/requests, update safely
+    if getattr(req, "headers", None):
+        req.headers.update(headers)
+    else:
+        req.headers = dict(headers)
+
+class _ResponseRecorder:
+    """Wraps an http object and keeps the headers of the last response."""
+
+    def __init__(self, http):
+        self._http = http
+        self.last_response = None
+
+    def request(self, *args, **kwargs):
+        resp, content = self._http.request(*args, **kwargs)
+        self.last_response = resp
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+def _filename_from_response(resp) -> Optional[str]:
+    disposition = resp.get("content-disposition") if resp else None
+    if not disposition:
+        return None
+    msg = Message()
+    msg["content-disposition"] = disposition
+    # Prefer RFC 2231 filename* (keeps non-ASCII names) over the plain filename
+    encoded = [v for k, v in msg.get_params([], header="content-disposition") if k == "filename" and isinstance(v, tuple)]
+    if encoded:
+        return email.utils.collapse_rfc2231_value(encoded[0])
+    return msg.get_filename()
+
+def _next_chunk_with_retry(downloader: MediaIoBaseDownload):
+    # The downloader keeps its offset, so a retry resumes with the next Range request
+    for attempt in range(CHUNK_ATTEMPTS):
+        try:
+            return downloader.next_chunk(num_retries=3)
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt == CHUNK_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, min(32, 2 ** attempt)))
 
-def export_google_file(file_id: str, resource_key: Optional[str] = None) -> Tuple[bytes, str]:
+def export_google_file(file_id: str, resource_key: Optional[str] = None, kind: str = "unknown") -> Tuple[bytes, str]:
     drive = get_drive_service()
+    http = get_drive_http()
     request_headers = {}
     if resource_key:
         request_headers["X-Goog-Drive-Resource-Keys"] = f"{file_id}/{resource_key}"
-    meta = (
-        drive.files()
-        .get(fileId=file_id, fields="name,mimeType")
-        .execute(headers=request_headers if request_headers else None)
-    )
-    name = meta.get("name", "file")
-    mime = meta.get("mimeType")
-
-    if mime == GOOGLE_DOC_MIME:
-        export_mime = DOCX_MIME
-        ext = ".docx"
-    elif mime == GOOGLE_SHEET_MIME:
-        export_mime = XLSX_MIME
-        ext = ".xlsx"
-    else:
-        raise ValueError(f"Unsupported mimeType: {mime}")
 
-    req = drive.files().export_media(fileId=file_id, mimeType=export_mime)
-    if request_headers:
-        # req.headers can be None in some googleapiclient versions/requests, update safely
-        if getattr(req, "headers", None):
-            req.headers.update(request_headers)
+    name = None
+    modified_time = None
+    if kind in KIND_EXPORTS:
+        # Type is known from the link, no need for a metadata round trip
+        export_mime, ext = KIND_EXPORTS[kind]
+    else:
+        meta_req = drive.files().get(fileId=file_id, fields="name,mimeType,modifiedTime")
+        _set_headers(meta_req, request_headers)
+        meta = meta_req.execute(http=http)
+        name = meta.get("name", "file")
+        mime = meta.get("mimeType")
+        modified_time = meta.get("modifiedTime")
+
+        if mime == GOOGLE_DOC_MIME:
+            export_mime, ext = KIND_EXPORTS["doc"]
+        elif mime == GOOGLE_SHEET_MIME:
+            export_mime, ext = KIND_EXPORTS["sheet"]
         else:
-            req.headers = dict(request_headers)
+            raise ValueError(f"Unsupported mimeType: {mime}")
 
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, req)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
+    cached = cache_get(file_id, export_mime)
+    if cached is not None and modified_time is not None and cached.modified_time == modified_time:
+        return cached.data, cached.filename
 
-    fh.seek(0)
+    req = drive.files().export_media(fileId=file_id, mimeType=export_mime)
+    _set_headers(req, request_headers)
+    if cached is not None and cached.etag:
+        # Drive answers 304 if the export is still the one we have
+        _set_headers(req, {"If-None-Match": cached.etag})
+    recorder = _ResponseRecorder(http)
+    req.http = recorder
+
+    # The whole export is buffered on purpose: PTB's InputFile reads the full
+    # payload before uploading, so streaming chunks to Telegram would not save memory
+    fh = io.BytesIO()
+    try:
+        downloader = MediaIoBaseDownload(fh, req, chunksize=CHUNK_SIZE)
+        done = False
+        while not done:
+            _, done = _next_chunk_with_retry(downloader)
+    except HttpError as e:
+        if e.resp.status == 304 and cached is not None:
+            return cached.data, cached.filename
+        if e.resp.status in (400, 403) and kind in KIND_EXPORTS:
+            # Uploaded .docx/.xlsx opened in Office mode share the Docs/Sheets URL but can't be
+            # exported; check the real mimeType so an unsupported file is reported as such
+            return export_google_file(file_id, resource_key, "unknown")
+        raise
+
+    if name is None:
+        name = _filename_from_response(recorder.last_response) or file_id
+
+    # getvalue() hands over BytesIO's own buffer; the cache and the reply share that one copy
+    data = fh.getvalue()
+    fh.close()
     filename = name if name.lower().endswith(ext) else (name + ext)
-    return fh.read(), filename
+    etag = recorder.last_response.get("etag") if recorder.last_response else None
+    if modified_time is not None or etag:
+        cache_put(file_id, export_mime, CachedExport(modified_time, etag, filename, data))
+    return data, filename
 
 def is_allowed_user(update: Update) -> bool:
-    allowed = os.environ.get("ALLOWED_USER_ID", "").strip()
-    if not allowed:
-        return True
-    return update.effective_user and str(update.effective_user.id) == allowed
+    return not _ALLOWED_IDS or bool(update.effective_user and update.effective_user.id in _ALLOWED_IDS)
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed_user(update):
@@ -141,34 +306,47 @@ async def cmd_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id if update.effective_user else "unknown"
     await update.message.reply_text(f"Твой user_id: {uid}")
 
+async def _process_one(update: Update, file_id: str, resource_key: Optional[str], kind: str):
+    try:
+        await update.message.reply_text("Конвертирую и скачиваю…")
+        async with _export_semaphore:
+            data, filename = await asyncio.get_running_loop().run_in_executor(
+                _DRIVE_POOL, export_google_file, file_id, resource_key, kind
+            )
+            await update.message.reply_document(document=data, filename=filename)
+    except ValueError as ve:
+        await update.message.reply_text(f"Не поддерживается: {ve}")
+    except Exception:
+        logging.exception("Failed to export")
+        await update.message.reply_text(
+            "Ошибка скачивания/конвертации.\n"
+            "Проверь: файл расшарен на service account email, ссылка верная (с resourcekey), Drive API включен."
+        )
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed_user(update):
         return
 
-    text = (update.message.text or "").strip()
-    file_refs = extract_file_refs(text)
+    file_refs = extract_file_refs(message_link_text(update.message))
     if not file_refs:
         await update.message.reply_text("Не вижу ссылки на Google Docs/Sheets. Пришли ссылку.")
         return
 
-    for file_id, resource_key in file_refs:
-        try:
-            await update.message.reply_text("Конвертирую и скачиваю…")
-            data, filename = await asyncio.to_thread(export_google_file, file_id, resource_key)
-            bio = io.BytesIO(data)
-            bio.name = filename
-            bio.seek(0)
-            await update.message.reply_document(document=bio, filename=filename)
-        except ValueError as ve:
-            await update.message.reply_text(f"Не поддерживается: {ve}")
-        except Exception:
-            logging.exception("Failed to export")
-            await update.message.reply_text(
-                "Ошибка скачивания/конвертации.\n"
-                "Проверь: файл расшарен на service account email, ссылка верная (с resourcekey), Drive API включен."
-            )
+    await asyncio.gather(
+        *[_process_one(update, file_id, resource_key, kind) for file_id, resource_key, kind in file_refs]
+    )
+
+async def warm_up(app: Application):
+    # Build the Drive client before the webhook starts, off the event loop
+    await asyncio.get_running_loop().run_in_executor(_DRIVE_POOL, get_drive_service)
 
 def main():
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logging.info("uvloop not installed, using the default asyncio loop")
+
     bot_token = _env("BOT_TOKEN")
     # На Render эта переменная автоматически содержит https://<service>.onrender.com
     base_url = os.environ.get("WEBHOOK_BASE_URL") or os.environ.get("RENDER_EXTERNAL_URL")
@@ -178,7 +356,7 @@ def main():
     path = _env("WEBHOOK_PATH")  # любая случайная строка
     port = int(os.environ.get("PORT", "8080"))
 
-    app = Application.builder().token(bot_token).build()
+    app = Application.builder().token(bot_token).post_init(warm_up).build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("id", cmd_id))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
@@ -0,0 +1,58 @@
+import pytest
+
+main = pytest.importorskip("main")
+httplib2 = pytest.importorskip("httplib2")
+
+
+class _FakeRequest:
+    def __init__(self, result=None):
+        self.headers = {}
+        self.http = None
+        self._result = result
+
+    def execute(self, http=None):
+        return self._result
+
+
+class _FakeFiles:
+    def __init__(self, meta):
+        self._meta = meta
+        self.calls = []
+
+    def get(self, **kwargs):
+        self.calls.append("get")
+        return _FakeRequest(self._meta)
+
+    def export_media(self, **kwargs):
+        self.calls.append("export_media")
+        return _FakeRequest()
+
+
+class _FakeDrive:
+    def __init__(self, meta):
+        self._files = _FakeFiles(meta)
+
+    def files(self):
+        return self._files
+
+
+class _ForbiddenDownload:
+    def __init__(self, fh, req, chunksize=None):
+        pass
+
+    def next_chunk(self, num_retries=0):
+        raise main.HttpError(httplib2.Response({"status": 403}), b"Export only supports Docs Editors files.")
+
+
+def test_office_file_behind_docs_link_is_reported_unsupported(monkeypatch):
+    drive = _FakeDrive({"name": "report.docx", "mimeType": main.DOCX_MIME})
+    monkeypatch.setattr(main, "get_drive_service", lambda: drive)
+    monkeypatch.setattr(main, "get_drive_http", lambda: None)
+    monkeypatch.setattr(main, "MediaIoBaseDownload", _ForbiddenDownload)
+
+    file_id, resource_key, kind = main.extract_file_refs(
+        "https://docs.google.com/document/d/OFFICE1/edit?usp=sharing&rtpof=true&sd=true"
+    )[0]
+    with pytest.raises(ValueError, match="Unsupported mimeType"):
+        main.export_google_file(file_id, resource_key, kind)
+    assert drive.files().calls == ["export_media", "get"]
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+def test_single_link():
+    assert main.extract_file_refs(
+        "https://docs.google.com/document/d/AAA/edit?usp=sharing&resourcekey=RK"
+    ) == [("AAA", "RK", "doc")]
+    assert main.extract_file_refs("https://docs.google.com/spreadsheets/d/BBB/edit#gid=0") == [
+        ("BBB", None, "sheet")
+    ]
+
+
+@pytest.mark.parametrize("sep", [",", "\t", " ", "\n", ""])
+def test_multiple_links_are_all_found(sep):
+    text = sep.join(
+        ["https://docs.google.com/document/d/A/edit", "https://docs.google.com/spreadsheets/d/B/edit"]
+    )
+    assert main.extract_file_refs(text) == [("A", None, "doc"), ("B", None, "sheet")]
+
+
+def test_link_with_id_parameter():
+    assert main.extract_file_refs("https://docs.google.com/document/d/A/edit?id=B") == [
+        ("A", None, "doc"),
+        ("B", None, "unknown"),
+    ]
+
+
+def test_no_links():
+    assert main.extract_file_refs("привет") == []
+
+
+def test_hyperlink_entities_are_scanned_with_the_text():
+    message = SimpleNamespace(
+        text="вот документ и таблица https://docs.google.com/document/d/A/edit",
+        entities=[
+            SimpleNamespace(url=None),
+            SimpleNamespace(url="https://docs.google.com/spreadsheets/d/B/edit"),
+            SimpleNamespace(url="https://docs.google.com/document/d/A/edit?usp=sharing"),
+        ],
+    )
+    assert main.extract_file_refs(main.message_link_text(message)) == [
+        ("A", None, "doc"),
+        ("B", None, "sheet"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://docs.google.com/document/d/A/edit",
+        "https://docs.google.com/document/d/A/edit?usp=sharing&resourcekey=RK",
+        "https://docs.google.com/document/d/A/edit?resourcekey=RK&resourcekey=RK2",
+        "https://docs.google.com/document/d/A/edit?x=1?resourcekey=R2",
+        "https://docs.google.com/spreadsheets/d/B/edit#gid=0",
+        "https://docs.google.com/spreadsheets/d/B/edit?resourcekey=RK#gid=0",
+        "https://drive.google.com/file/d/C/view?usp=sharing",
+        "http://docs.google.com/document/d/A",
+    ],
+)
+def test_single_link_fast_path_matches_general_scanner(url):
+    # A leading space keeps the text off the fast path
+    assert main.extract_file_refs(url) == main.extract_file_refs(" " + url)